@@ -1,14 +1,31 @@
 import time
-import websocket
-import json
-import base64
+import asyncio
+import websockets
+import orjson
 import logging
 import os
+import queue
 import ssl
 import threading
 
 from dotenv import load_dotenv
 from audio import AudioHandler
+
+try:
+    # SIMD-accelerated base64 codec
+    from pybase64 import b64decode, b64encode
+except ImportError:
+    from binascii import a2b_base64 as b64decode, b2a_base64
+
+    def b64encode(data):
+        return b2a_base64(data, newline=False)
+
+try:
+    # libuv-based event loop, faster socket I/O than the default asyncio loop
+    import uvloop
+except ImportError:
+    uvloop = None  # Not available on Windows
+
 load_dotenv()
 
 logging.basicConfig(level=logging.DEBUG,
@@ -23,7 +40,21 @@ class RealTimeAgent:
     Possible events: https://platform.openai.com/docs/api-reference/realtime-client-events
     """
 
-    def __init__(self, instructions, voice="alloy"):
+    # Fixed JSON envelope of input_audio_buffer.append; base64 needs no escaping
+    _APPEND_PREFIX = b'{"type":"input_audio_buffer.append","audio":"'
+    _APPEND_SUFFIX = b'"}'
+
+    def __init__(self, instructions, voice="alloy", batch_chunks=4, play_mode="stream", vad_silence_ms=400):
+        """
+        :param instructions: System instructions for the model
+        :param voice: Voice used for audio responses
+        :param batch_chunks: Number of recorded chunks sent per input_audio_buffer.append event
+        :param play_mode: "stream" plays response audio as it arrives, "buffered" plays it once complete
+        :param vad_silence_ms: Silence (ms) before server VAD detects the end of speech
+        """
+        if play_mode not in ("stream", "buffered"):
+            raise ValueError(f"Unknown play_mode: {play_mode}")
+
         # WebSocket Configuration
         self.url = "wss://api.openai.com/v1/realtime"  # WebSocket URL
         self.model = "gpt-4o-mini-realtime-preview"
@@ -31,14 +62,19 @@ class RealTimeAgent:
         self.ws = None
         self.audio_handler = AudioHandler()
 
-        # SSL Configuration (skipping certificate verification)
+        # SSL Configuration, created once and reused for every connection
         self.ssl_context = ssl.create_default_context()
-        self.ssl_context.check_hostname = False
-        self.ssl_context.verify_mode = ssl.CERT_NONE
 
-        self.audio_buffer = b''  # Buffer for streaming audio responses
+        self.audio_buffer = bytearray()  # Buffer for streaming audio responses
         self.instructions = instructions
         self.voice = voice
+        self.play_mode = play_mode
+
+        # Recorded chunks are coalesced into one input_audio_buffer.append event.
+        # 4 chunks of 1024 frames is ~170 ms at 24 kHz, well under the VAD silence window.
+        self.batch_chunks = batch_chunks
+        # Streamed response audio is played once it reaches this size
+        self.play_bytes = batch_chunks * self.audio_handler.chunk_size * self.audio_handler.sample_width
 
         # VAD mode (set to null to disable)
         self.VAD_turn_detection = True
@@ -49,7 +85,7 @@ class RealTimeAgent:
             # Audio to include before the VAD detected speech.
             "prefix_padding_ms": 300,
             # Silence to detect speech stop. With lower values the model will respond more quickly.
-            "silence_duration_ms": 400
+            "silence_duration_ms": vad_silence_ms
         }
 
         self.session_config = {
@@ -64,96 +100,178 @@ class RealTimeAgent:
             },
             "temperature": 0.6
         }
+        # Encoded once up front; rebuild it if session_config is changed after construction
+        self.session_update = orjson.dumps({
+            "type": "session.update",
+            "session": self.session_config
+        })
+
+        # Server event handlers, looked up by event type for every received message
+        self.event_handlers = {
+            "response.audio.delta": self.__on_audio_delta,
+            "response.audio.done": self.__on_audio_done,
+            "response.done": self.__on_response_done,
+            "conversation.item.created": self.__on_item_created,
+            "input_audio_buffer.speech_started": self.__on_speech_started,
+            "input_audio_buffer.speech_stopped": self.__on_speech_stopped,
+            "session.created": self.__on_session_created,
+            "session.updated": self.__on_session_updated,
+        }
+
+        # Response audio is decoded on a separate thread so the event loop keeps receiving.
+        # Items are base64 deltas, None marks the end of a response's audio.
+        self.decode_queue = queue.Queue()
+        self.decode_thread = threading.Thread(target=self.__decode_audio)
+        self.decode_thread.daemon = True
+        self.decode_thread.start()
 
     def run(self):
+        if uvloop:
+            uvloop.run(self.__run())
+        else:
+            asyncio.run(self.__run())
+
+    async def __run(self):
         logger.info(f"Connecting to WebSocket: {self.url}")
         headers = {
             "Authorization": f"Bearer {self.api_key}",
             "OpenAI-Beta": "realtime=v1"
         }
-        self.ws = websocket.WebSocketApp(
-            f"{self.url}?model={self.model}",
-            header=headers,
-            on_open=self.__on_open,
-            on_message=self.__on_message,
-            on_error=self.__on_error,
-        )
-
         try:
-            self.ws.run_forever()
+            async with websockets.connect(
+                f"{self.url}?model={self.model}",
+                additional_headers=headers,
+                compression="deflate",  # permessage-deflate, base64 deltas compress well
+                max_size=2 ** 22,  # Allow server events up to 4 MiB
+                ssl=self.ssl_context,
+                # Keepalive pings to detect dead links instead of hanging on them
+                ping_interval=20,
+                ping_timeout=10,
+            ) as ws:
+                self.ws = ws
+                await self.__on_open()
+                listen_task = asyncio.create_task(self.__listen())
+                try:
+                    await self.__receive()
+                finally:
+                    listen_task.cancel()
+                    # Let __listen stop recording before the audio handler is closed
+                    await asyncio.gather(listen_task, return_exceptions=True)
         except Exception as e:
             logger.error(f"WebSocket connection error: {e}")
+        finally:
+            self.audio_handler.close()
 
     # To send a client event, serialize a dictionary to JSON
     # of the proper event type
-    def __on_open(self, ws):
+    async def __on_open(self):
         logger.info("Connected to server.")
 
         # Configure session
-        self.__send_event(
-            {
-                "type": "session.update",
-                "session": self.session_config
-            }
-        )
+        await self.__send_event(self.session_update)
         logger.info(f"Session set up to:\n{self.session_config}")
 
-        # Start a separate thread to listen for audio input
-        self.processing_thread = threading.Thread(target=self.__listen)
-        self.processing_thread.daemon = True
-        self.processing_thread.start()
-        self.listen_event = threading.Event()
+        # Listen for audio input until the server detects the end of speech
+        self.listen_event = asyncio.Event()
         self.listen_event.set()
 
+    async def __receive(self):
+        try:
+            while True:
+                # Keep text frames as bytes: orjson parses them without a str decode
+                message = await self.ws.recv(decode=False)
+                self.__on_message(message)
+        except websockets.ConnectionClosedOK:
+            logger.info("Connection closed.")
+
     # Receiving messages will require parsing message payloads from JSON
-    def __on_message(self, ws, message):
-        event = json.loads(message)
-        # logger.info(f"Received event: {json.dumps(event, indent=2)}")
-        if event["type"] == "response.audio.delta":
-            # Append audio data to buffer
-            audio_data = base64.b64decode(event["delta"])
-            self.audio_handler.play_audio(audio_data)
-        elif event["type"] == "response.audio.done":
-            logger.info("Done playing audio response")
-        elif event["type"] == "response.done":
-            logger.debug("Response generation completed and starting to listen for audio input again")
-            # Start to listen for audio input again
-            self.listen_event.set()
-        elif event["type"] == "conversation.item.created":
-            logger.debug(f"Conversation item created: {event.get('item')}")
-        elif event["type"] == "input_audio_buffer.speech_started":
-            logger.debug("Speech started detected by server VAD")
-        elif event["type"] == "input_audio_buffer.speech_stopped":
-            logger.debug("Speech stopped detected by server VAD")
-            # Stop listening for audio input
-            self.listen_event.clear()
-        elif event["type"] == "session.created":
-            logger.debug(f"Session created: {event.get('session')}")
-        elif event["type"] == "session.updated":
-            logger.debug(f"Session updated: {event.get('session')}")
+    def __on_message(self, message):
+        event = orjson.loads(message)
+        # logger.info(f"Received event: {orjson.dumps(event, option=orjson.OPT_INDENT_2).decode()}")
+        handler = self.event_handlers.get(event["type"])
+        if handler:
+            handler(event)
         else:
-            logger.debug(f"Unhandled event type: {event['type']}")
+            logger.debug("Unhandled event type: %s", event['type'])
+
+    def __on_audio_delta(self, event):
+        self.decode_queue.put(event["delta"])
+
+    def __on_audio_done(self, event):
+        self.decode_queue.put(None)
+        logger.info("Audio response received")
+
+    def __on_response_done(self, event):
+        logger.debug("Response generation completed and starting to listen for audio input again")
+        # Start to listen for audio input again
+        self.listen_event.set()
+
+    def __on_item_created(self, event):
+        logger.debug("Conversation item created: %s", event.get('item'))
+
+    def __on_speech_started(self, event):
+        logger.debug("Speech started detected by server VAD")
 
-    def __on_error(self, ws, error):
-        logger.error(f"WebSocket error: {error}")
-    
-    def __listen(self):
+    def __on_speech_stopped(self, event):
+        logger.debug("Speech stopped detected by server VAD")
+        # Stop listening for audio input
+        self.listen_event.clear()
+
+    def __on_session_created(self, event):
+        logger.debug("Session created: %s", event.get('session'))
+
+    def __on_session_updated(self, event):
+        logger.debug("Session updated: %s", event.get('session'))
+
+    def __decode_audio(self):
+        '''Decode response audio deltas and hand them to the player'''
+        while True:
+            delta = self.decode_queue.get()
+            if delta is None:
+                # Play whatever is left of the response
+                self.__play_buffered_audio()
+            else:
+                # Append audio data to buffer
+                self.audio_buffer += b64decode(delta)
+                if self.play_mode == "stream" and len(self.audio_buffer) >= self.play_bytes:
+                    self.__play_buffered_audio()
+            self.decode_queue.task_done()
+
+    def __wait_playback(self):
+        # Wait for queued deltas to be decoded, then for the player to drain
+        self.decode_queue.join()
+        self.audio_handler.wait_playback()
+
+    def __play_buffered_audio(self):
+        if self.audio_buffer:
+            # Hand the buffer itself to the player instead of copying it
+            self.audio_handler.play_audio(self.audio_buffer)
+            self.audio_buffer = bytearray()
+
+    async def __listen(self):
         '''Keep sending audio chunks to the server'''
         self.audio_handler.start_recording()
+        debug = logger.isEnabledFor(logging.DEBUG)
         try:
             while True:
-                self.listen_event.wait()
-                chunk = self.audio_handler.record_chunk()
-                if chunk:
-                    # Encode and send audio chunk
-                    base64_chunk = base64.b64encode(chunk).decode('utf-8')
-                    self.__send_event({
-                        "type": "input_audio_buffer.append",
-                        "audio": base64_chunk
-                    })
-                else:
-                    logger.debug("No audio chunk received")
+                if not self.listen_event.is_set():
+                    await self.listen_event.wait()
+                    # Drop audio captured while the response was being generated and played
+                    await asyncio.to_thread(self.__wait_playback)
+                    self.audio_handler.discard_recording()
+                # Blocking queue reads run in a worker thread to keep the event loop free
+                batch = await asyncio.to_thread(self.audio_handler.record_batch, self.batch_chunks)
+                if batch is None:
+                    logger.debug("Audio input stream closed")
                     break
+                if batch:
+                    # Encode and send the batched audio chunks in a single event
+                    await self.__send_event(self._APPEND_PREFIX + b64encode(batch) + self._APPEND_SUFFIX)
+                    if debug:
+                        logger.debug("Event sent - type: input_audio_buffer.append")
+                else:
+                    # Keep listening, the microphone may just be stalled
+                    logger.warning(f"No audio recorded for {self.audio_handler.record_timeout} s")
         except Exception as e:
             logger.error(f"Error during audio recording: {e}")
             self.audio_handler.stop_recording()
@@ -164,14 +282,14 @@ class RealTimeAgent:
             self.audio_handler.stop_recording()
             logger.debug("Audio recording stopped")
 
-    def __send_event(self, event):
+    async def __send_event(self, payload):
         """
         Send an event to the WebSocket server.
 
-        :param event: Event data to send (from the user)
+        :param payload: JSON-encoded event data to send (from the user)
         """
-        self.ws.send(json.dumps(event))
-        logger.debug(f"Event sent - type: {event['type']}")
+        # Events are pre-encoded UTF-8 bytes, sent as-is in a text frame
+        await self.ws.send(payload, text=True)
 
 
 if __name__ == "__main__":
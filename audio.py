@@ -1,5 +1,12 @@
+import collections
+import logging
+import queue
+import time
+
 import pyaudio
 
+logger = logging.getLogger(__name__)
+
 class AudioHandler:
     """
     Handles audio input and output using PyAudio.
@@ -10,13 +17,22 @@ class AudioHandler:
         self.format = pyaudio.paInt16  # Audio format (16-bit PCM)
         self.channels = 1  # Mono audio
         self.rate = 24000  # Sampling rate in Hz
+        self.sample_width = self.p.get_sample_size(self.format)  # Bytes per frame (mono)
 
         self.input_stream = None
+        self.record_timeout = 1.0  # Seconds to wait for a recorded chunk
+        self._record_queue = queue.SimpleQueue()  # Filled by the PortAudio callback thread
+        self._rec_buf = None  # Reused for batched reads, allocated on first use
+        self._play_queue = collections.deque()  # Drained by the PortAudio callback thread
+        self._silence = bytes(self.chunk_size * self.sample_width)  # Played on underflow
+        self._closed = False
         self.output_stream = self.p.open(
             format=self.format,
             channels=self.channels,
             rate=self.rate,
-            output=True
+            output=True,
+            frames_per_buffer=self.chunk_size,
+            stream_callback=self._play_callback
         )
 
     def start_recording(self):
@@ -28,28 +44,115 @@ class AudioHandler:
             channels=self.channels,
             rate=self.rate,
             input=True,
-            frames_per_buffer=self.chunk_size
+            frames_per_buffer=self.chunk_size,
+            stream_callback=self._record_callback
         )
 
+    def _record_callback(self, in_data, frame_count, time_info, status):
+        """Called by PortAudio on its own thread for every recorded chunk"""
+        if status & pyaudio.paInputOverflow:
+            # Nothing is raised in callback mode, PortAudio just reports the dropped samples
+            logger.warning("Audio input overflow, some samples were dropped")
+        self._record_queue.put_nowait(in_data)
+        return None, pyaudio.paContinue
+
     def stop_recording(self):
         """
-        Clean up resources by stopping the stream and terminating PyAudio.
+        Stop and close the audio input stream.
         """
         if self.input_stream:
             self.input_stream.stop_stream()
             self.input_stream.close()
+            self.input_stream = None
+
+    def close(self):
+        """
+        Clean up resources by closing the streams and terminating PyAudio.
+        """
+        # Queued audio will never be played, release anyone waiting on it
+        self._closed = True
+        self._play_queue.clear()
+        self.stop_recording()
+        self.output_stream.stop_stream()
+        self.output_stream.close()
         self.p.terminate()
 
     def record_chunk(self):
-        """Record a single chunk of audio"""
+        """
+        Record a single chunk of audio.
+
+        :return: The chunk, b'' if none arrived within record_timeout, or None if not recording
+        """
         if self.input_stream:
-            return self.input_stream.read(self.chunk_size)
+            try:
+                return self._record_queue.get(timeout=self.record_timeout)
+            except queue.Empty:
+                return b''
         return None
+
+    def discard_recording(self):
+        """Drop the chunks recorded so far but not consumed yet"""
+        try:
+            while True:
+                self._record_queue.get_nowait()
+        except queue.Empty:
+            pass
+
+    def record_batch(self, num_chunks):
+        """
+        Record several chunks into a reused buffer.
+
+        :param num_chunks: Number of chunks to record
+        :return: View of the recorded audio, only valid until the next call. It is shorter
+            (possibly empty) if no chunk arrived within record_timeout, and None if not recording.
+        """
+        if not self.input_stream:
+            return None
+        size = num_chunks * self.chunk_size * self.sample_width
+        if self._rec_buf is None or len(self._rec_buf) != size:
+            self._rec_buf = bytearray(size)
+        view = memoryview(self._rec_buf)
+        offset = 0
+        while offset < size:
+            chunk = self.record_chunk()
+            if chunk is None:
+                return None
+            if not chunk:
+                return view[:offset]
+            view[offset:offset + len(chunk)] = chunk
+            offset += len(chunk)
+        return view
     
+    def _play_callback(self, in_data, frame_count, time_info, status):
+        """Called by PortAudio on its own thread to fill the next output buffer"""
+        size = frame_count * self.sample_width
+        if not self._play_queue and size == len(self._silence):
+            return self._silence, pyaudio.paContinue
+        parts = []
+        while size and self._play_queue:
+            chunk = self._play_queue.popleft()
+            if len(chunk) > size:
+                # Put the remainder back in front; slicing a memoryview doesn't copy
+                self._play_queue.appendleft(chunk[size:])
+                chunk = chunk[:size]
+            parts.append(chunk)
+            size -= len(chunk)
+        if size:
+            # Pad with silence on underflow
+            parts.append(memoryview(self._silence)[:size] if size <= len(self._silence) else bytes(size))
+        # PyAudio only accepts bytes here, so this join is the one copy out of the queue
+        return b''.join(parts), pyaudio.paContinue
+
     def play_audio(self, audio_data):
         """
-        Play audio data.
+        Queue audio data for playback without blocking. The data is not copied,
+        so it must not be modified afterwards.
         
         :param audio_data: Received audio data (AI response)
         """
-        self.output_stream.write(audio_data)
+        self._play_queue.append(memoryview(audio_data))
+
+    def wait_playback(self):
+        """Block until all queued audio has been played or the handler is closed"""
+        while self._play_queue and not self._closed:
+            time.sleep(self.chunk_size / self.rate)